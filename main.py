@@ -1,11 +1,22 @@
-import hashlib
-import json
+import asyncio
+import itertools
+import os
+import shutil
+import sqlite3
+import struct
 import subprocess
+import time
+from contextlib import asynccontextmanager
+from collections import OrderedDict
+from functools import lru_cache
 from pathlib import Path
 from typing import Optional
 
+import orjson
+import yt_dlp
+from blake3 import blake3
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, Response
 from pydantic import BaseModel
 
 # =====================================================
@@ -17,17 +28,53 @@ BASE_DIR = Path(__file__).parent
 STORAGE = BASE_DIR / "storage"
 VIDEO_DIR = STORAGE / "videos"
 AUDIO_DIR = STORAGE / "audio"
-META_DIR = STORAGE / "meta"
 TMP_DIR = STORAGE / "tmp"
 
-for d in (VIDEO_DIR, AUDIO_DIR, META_DIR, TMP_DIR):
-    d.mkdir(parents=True, exist_ok=True)
+# Строковые префиксы для горячих путей: склейка строк вместо Path-арифметики
+STORAGE_PREFIX = str(STORAGE) + os.sep
+VIDEO_PREFIX = str(VIDEO_DIR) + os.sep
+AUDIO_PREFIX = str(AUDIO_DIR) + os.sep
+
+# Метаданные всех рилов в одной SQLite-базе (WAL): поиск по первичному ключу
+# вместо файла на каждый рил, очистка — один DELETE.
+# Открывается в lifespan, чтобы импорт модуля не трогал диск
+META_DB: Optional[sqlite3.Connection] = None
 
 COOKIES_FILE = BASE_DIR / "cookies.txt"  # можно удалить, если не используешь
 
 USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64)"
 
-app = FastAPI(title="Reels Backend (Local)")
+# Потребительские GPU держат ограниченное число одновременных NVENC-сессий
+# (NVENC_SESSIONS на GPU). Воркер забирает из очереди до TRANSCODE_BATCH
+# рилов в один ffmpeg, и каждый клип пачки — отдельная сессия, поэтому
+# воркеров на GPU × размер пачки не превышает NVENC_SESSIONS
+N_GPUS = int(os.getenv("N_GPUS", "1"))
+NVENC_SESSIONS = max(1, int(os.getenv("NVENC_SESSIONS", "4")))
+WORKERS_PER_GPU = min(2, NVENC_SESSIONS)
+TRANSCODE_WORKERS = N_GPUS * WORKERS_PER_GPU
+TRANSCODE_BATCH = max(1, min(
+    int(os.getenv("TRANSCODE_BATCH", "2")),
+    NVENC_SESSIONS // WORKERS_PER_GPU
+))
+
+# (raw_video, final_video, final_audio, future с has_audio).
+# Создаётся в lifespan, в event loop приложения
+_TRANSCODE_QUEUE: Optional[asyncio.Queue] = None
+
+# reel_id -> фоновый пайплайн, который сейчас собирает этот рил.
+# Каждый держит задачу, место в очереди транскода и raw-файл в TMP_DIR,
+# поэтому сверх MAX_INFLIGHT новые сборки не принимаем (503)
+MAX_INFLIGHT = int(os.getenv("MAX_INFLIGHT", "64"))
+_inflight: dict[str, asyncio.Task] = {}
+# reel_id -> текст ошибки последней неудачной сборки. Ключ выводится из
+# URL клиента, поэтому храним только FAILED_MAX последних ошибок
+FAILED_MAX = 1024
+_failed: OrderedDict[str, str] = OrderedDict()
+
+# Если перед сервисом стоит NGINX, файлы отдаёт он через sendfile:
+#   location /internal/ { internal; alias /app/storage/; }
+# и ACCEL_REDIRECT_PREFIX=/internal. Без переменной отдаём сами
+ACCEL_REDIRECT_PREFIX = os.getenv("ACCEL_REDIRECT_PREFIX", "").rstrip("/")
 
 # =====================================================
 # MODELS
@@ -46,28 +93,256 @@ class ReelResponse(BaseModel):
     height: int
 
 
+class ReelStatus(BaseModel):
+    id: str
+    status: str  # processing | done | failed
+    statusUrl: str
+    error: Optional[str] = None
+    reel: Optional[ReelResponse] = None
+
+
 # =====================================================
 # UTILS
 # =====================================================
 
-def run(cmd: list[str]) -> str:
+# stdout нужен только ffprobe, остальным — DEVNULL. stderr остаётся в пайпе
+# ради текста ошибки, но ffmpeg запускается с -loglevel error -nostats,
+# так что прогресс-строк там нет, а декодируем его только при падении
+async def run(
+    cmd: list[str],
+    capture_stdout: bool = False,
+    cores: Optional[list[int]] = None
+) -> Optional[bytes]:
+    if cores:
+        cmd = ["taskset", "-c", ",".join(map(str, cores)), *cmd]
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE if capture_stdout else asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE
+    )
+    stdout, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(stderr.decode(errors="replace").strip())
+    return stdout
+
+
+# FileNotFoundError уходит наверх, хендлер превращает его в 404.
+# stat делаем сами и передаём в ответ: FileResponse тогда не ходит
+# за ним в threadpool на каждый запрос
+def file_response(path: str, media_type: str):
+    stat_result = os.stat(path)
+    name = os.path.basename(path)
+    if ACCEL_REDIRECT_PREFIX:
+        return Response(
+            media_type=media_type,
+            headers={
+                "X-Accel-Redirect": ACCEL_REDIRECT_PREFIX + "/" + path[len(STORAGE_PREFIX):],
+                "Content-Disposition": f'attachment; filename="{name}"',
+            }
+        )
+    # Range и pathsend (где сервер его поддерживает) FileResponse умеет сам
+    return FileResponse(
+        path,
+        media_type=media_type,
+        filename=name,
+        stat_result=stat_result
+    )
+
+
+def open_meta_db() -> sqlite3.Connection:
+    con = sqlite3.connect(
+        STORAGE / "meta.db",
+        check_same_thread=False,
+        isolation_level=None
+    )
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS reels (
+            id TEXT PRIMARY KEY,
+            duration REAL NOT NULL,
+            width INTEGER NOT NULL,
+            height INTEGER NOT NULL,
+            has_audio INTEGER NOT NULL,
+            created_at REAL NOT NULL
+        )
+    """)
+    return con
+
+
+# Группы ядер с общим L3 (CCX/сокет) из доступных процессу
+def group_cores_by_llc() -> list[list[int]]:
+    groups: dict[str, list[int]] = {}
+    for cpu in sorted(os.sched_getaffinity(0)):
+        llc = Path(f"/sys/devices/system/cpu/cpu{cpu}/cache/index3/shared_cpu_list")
+        try:
+            key = llc.read_text().strip()
+        except OSError:
+            key = ""
+        groups.setdefault(key, []).append(cpu)
+    return list(groups.values())
+
+
+# Список энкодеров говорит только о том, как собран ffmpeg, а не о железе.
+# Прогоняем один кадр через ту же цепочку, что и в транскоде: так заодно
+# проверяются драйвер, CUDA, scale_npp (libnpp) и сам NVENC
+def has_nvenc() -> bool:
+    try:
+        proc = subprocess.run(
+            [
+                "ffmpeg", "-hide_banner", "-loglevel", "error",
+                "-f", "lavfi", "-i", "color=s=256x256",
+                "-frames:v", "1",
+                "-vf", "hwupload_cuda,scale_npp=256:-2:format=yuv420p",
+                "-c:v", "h264_nvenc",
+                "-f", "null", "-"
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            timeout=60
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    return proc.returncode == 0
+
+
+def nvenc_options() -> str:
     proc = subprocess.run(
-        cmd,
+        ["ffmpeg", "-hide_banner", "-h", "encoder=h264_nvenc"],
         stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
         text=True
     )
-    if proc.returncode != 0:
-        raise RuntimeError(proc.stderr.strip())
     return proc.stdout
 
 
 def hash_url(url: str) -> str:
-    return hashlib.sha256(url.encode()).hexdigest()[:12]
+    # Ключ кэша, не криптография: 6 байт BLAKE3 (те же 12 hex-символов)
+    return blake3(url.encode()).hexdigest(length=6)
+
+
+def iter_boxes(data: bytes):
+    # (type, payload) для боксов ISO BMFF внутри data
+    pos = 0
+    while pos + 8 <= len(data):
+        size, box_type = struct.unpack_from(">I4s", data, pos)
+        header = 8
+        if size == 1:
+            size, = struct.unpack_from(">Q", data, pos + 8)
+            header = 16
+        elif size == 0:
+            size = len(data) - pos
+        if size < header:
+            raise struct.error(f"bad box size {size}")
+        yield box_type, data[pos + header:pos + size]
+        pos += size
+
+
+def read_moov(f) -> bytes:
+    # Идём по боксам верхнего уровня, пока не найдём moov.
+    # С +faststart он лежит сразу после ftyp
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            raise struct.error("moov not found")
+        size, box_type = struct.unpack(">I4s", header)
+        header_size = 8
+        if size == 1:
+            size, = struct.unpack(">Q", f.read(8))
+            header_size = 16
+        elif size == 0:
+            raise struct.error("moov not found")
+        if size < header_size:
+            raise struct.error(f"bad box size {size}")
+        if box_type == b"moov":
+            return f.read(size - header_size)
+        f.seek(size - header_size, os.SEEK_CUR)
+
+
+def parse_mp4_header(path: Path):
+    with path.open("rb") as f:
+        moov = read_moov(f)
+
+    duration = None
+    width = height = 0
+
+    for box_type, payload in iter_boxes(moov):
+        if box_type == b"mvhd":
+            if payload[0] == 1:
+                timescale, length = struct.unpack_from(">IQ", payload, 20)
+            else:
+                timescale, length = struct.unpack_from(">II", payload, 12)
+            duration = length / timescale
+        elif box_type == b"trak" and not width:
+            for child_type, child in iter_boxes(payload):
+                if child_type == b"tkhd":
+                    # width/height в fixed-point 16.16 после матрицы
+                    offset = 84 if child[0] == 1 else 72
+                    w, h = struct.unpack_from(">II", child, 4 + offset)
+                    width, height = w >> 16, h >> 16
+
+    if duration is None or not width:
+        raise struct.error("mvhd/tkhd not found")
+    return duration, width, height
+
+
+# Промахи не кэшируются: lru_cache не запоминает исключения,
+# так что KeyError пролетает до вызывающего
+@lru_cache(maxsize=4096)
+def _load_meta(reel_id: str) -> dict:
+    row = META_DB.execute(
+        "SELECT duration, width, height, has_audio FROM reels WHERE id = ?",
+        (reel_id,)
+    ).fetchone()
+    if row is None:
+        raise KeyError(reel_id)
+    duration, width, height, has_audio = row
+    return {
+        "duration": duration,
+        "width": width,
+        "height": height,
+        "hasAudio": bool(has_audio)
+    }
+
+
+# meta пишется последним, но mp4 мог пропасть с диска — проверяем и его,
+# это один stat. Рил без видео считается промахом и собирается заново
+def cached_meta(reel_id: str) -> Optional[dict]:
+    try:
+        meta = _load_meta(reel_id)
+    except KeyError:
+        return None
+    if not os.path.exists(VIDEO_PREFIX + reel_id + ".mp4"):
+        # Сначала строку: иначе, как только ffmpeg начнёт писать новый mp4,
+        # снова отдадим старую meta. Дальше до save_meta будут только промахи,
+        # так что LRU сбрасывается один раз, а не на каждый опрос
+        META_DB.execute("DELETE FROM reels WHERE id = ?", (reel_id,))
+        _load_meta.cache_clear()
+        return None
+    return meta
+
+
+def save_meta(reel_id: str, meta: dict):
+    META_DB.execute(
+        "INSERT OR REPLACE INTO reels VALUES (?, ?, ?, ?, ?, ?)",
+        (
+            reel_id,
+            meta["duration"],
+            meta["width"],
+            meta["height"],
+            int(meta["hasAudio"]),
+            time.time()
+        )
+    )
 
 
-def get_video_info(path: Path):
-    out = run([
+async def get_video_info(path: Path):
+    try:
+        return parse_mp4_header(path)
+    except (struct.error, IndexError, ZeroDivisionError):
+        pass
+
+    out = await run([
         "ffprobe",
         "-v", "error",
         "-select_streams", "v:0",
@@ -75,24 +350,210 @@ def get_video_info(path: Path):
         "-show_entries", "format=duration",
         "-of", "json",
         str(path)
-    ])
-    data = json.loads(out)
+    ], capture_stdout=True)
+    data = orjson.loads(out)
     stream = data["streams"][0]
     duration = float(data["format"]["duration"])
     return duration, stream["width"], stream["height"]
 
 
-def extract_audio(src: Path, dst: Path):
-    run([
-        "ffmpeg",
-        "-y",
-        "-i", str(src),
-        "-vn",
-        "-acodec", "pcm_s16le",
-        "-ar", "44100",
-        "-ac", "2",
-        str(dst)
-    ])
+# =====================================================
+# TRANSCODE
+# =====================================================
+
+# CPU-цепочка нужна всегда: и без NVENC, и как запасной путь,
+# если транскод на GPU упал
+CPU_INPUT_ARGS: list[str] = []
+CPU_OUTPUT_ARGS = [
+    "-vf", "scale=720:-2",
+    "-r", "20",
+    "-c:v", "libx264",
+    "-pix_fmt", "yuv420p",
+]
+
+# Проверяем NVENC один раз при старте, чтобы не платить за это в каждом запросе
+NVENC_AVAILABLE = has_nvenc()
+
+if NVENC_AVAILABLE:
+    # decode -> scale -> encode целиком на GPU (NVDEC + NPP + NVENC).
+    # Запас кадров в пуле декодера даёт NVDEC работать на опережение,
+    # пока scale_npp/NVENC заняты предыдущими кадрами
+    GPU_INPUT_ARGS = [
+        "-hwaccel", "cuda",
+        "-hwaccel_output_format", "cuda",
+        "-extra_hw_frames", "8",
+    ]
+    # Low-latency CBR: без B-кадров и lookahead (это и делает LL-пресеты
+    # быстрыми), битрейт ограничен, чтобы отдача рилов была предсказуемой.
+    # -bf 0 безопасен и на Pascal, где B-кадры/b_ref_mode не поддерживаются
+    GPU_OUTPUT_ARGS = [
+        "-vf", "scale_npp=720:-2:format=yuv420p",
+        "-r", "20",
+        "-c:v", "h264_nvenc",
+        "-preset", os.getenv("NVENC_PRESET", "p4"),
+        "-tune", "ll",
+        "-rc", "cbr",
+        "-b:v", "2M",
+        "-maxrate", "2M",
+        "-bufsize", "4M",
+        "-rc-lookahead", "0",
+        "-spatial_aq", "0",
+        "-temporal_aq", "0",
+        "-g", "60",
+        "-bf", "0",
+    ]
+    # На Ada+ драйвер может сам резать кадр между несколькими NVENC;
+    # для 720p это только лишняя синхронизация
+    if "split_encode_mode" in nvenc_options():
+        GPU_OUTPUT_ARGS += ["-split_encode_mode", "disabled"]
+
+
+# Каждый транскод прибиваем к одной L3-группе по кругу, чтобы потоки
+# ffmpeg не скакали между CCX и не вымывали кэш с кадрами.
+# С одной группой (или без taskset) пиннинг ничего не даёт
+if hasattr(os, "sched_getaffinity") and shutil.which("taskset"):
+    CORE_GROUPS = group_cores_by_llc()
+else:
+    CORE_GROUPS = []
+_CORE_POOL = itertools.cycle(CORE_GROUPS) if len(CORE_GROUPS) > 1 else None
+
+
+AUDIO_OUTPUT_ARGS = [
+    "-acodec", "pcm_s16le",
+    "-ar", "44100",
+    "-ac", "2",
+]
+
+
+# gpu=None — CPU-цепочка (libx264)
+def input_args(gpu: Optional[int]) -> list[str]:
+    if gpu is None:
+        return CPU_INPUT_ARGS
+    return [*GPU_INPUT_ARGS, "-hwaccel_device", str(gpu)]
+
+
+def reel_outputs(
+    i: int,
+    video_dst: Path,
+    audio_dst: Optional[Path],
+    gpu: Optional[int],
+    threads: list[str]
+) -> list[str]:
+    outputs = [
+        "-map", f"{i}:v:0",
+        *(CPU_OUTPUT_ARGS if gpu is None else GPU_OUTPUT_ARGS),
+        *threads,
+        "-movflags", "+faststart",
+        str(video_dst),
+    ]
+    if audio_dst is not None:
+        outputs += [
+            "-map", f"{i}:a:0",
+            *AUDIO_OUTPUT_ARGS,
+            str(audio_dst),
+        ]
+    return outputs
+
+
+# Один процесс ffmpeg на пачку рилов: каждый raw_video демультиплексируется
+# один раз, на выходе у каждого mp4 без звука и (опционально) wav
+def ffmpeg_cmd(jobs: list[tuple], gpu: Optional[int], threads: list[str], with_audio: bool) -> list[str]:
+    cmd = ["ffmpeg", "-y", "-hide_banner", "-nostats", "-loglevel", "error"]
+    for src, _, _, _ in jobs:
+        cmd += [*input_args(gpu), "-i", str(src)]
+    for i, (_, video_dst, audio_dst, _) in enumerate(jobs):
+        cmd += reel_outputs(i, video_dst, audio_dst if with_audio else None, gpu, threads)
+    return cmd
+
+
+# Возвращает, удалось ли извлечь аудио
+async def transcode_single(job: tuple, gpu: Optional[int], cores: Optional[list[int]]) -> bool:
+    threads = ["-threads", str(len(cores))] if cores else []
+    _, _, audio_dst, _ = job
+    if audio_dst is None:
+        await run(ffmpeg_cmd([job], gpu, threads, with_audio=False), cores=cores)
+        return False
+
+    try:
+        await run(ffmpeg_cmd([job], gpu, threads, with_audio=True), cores=cores)
+        return True
+    except RuntimeError as e:
+        # На GPU повторяем без звука, только если его и правда нет (ffmpeg
+        # падает ещё на настройке выходов). Любая другая ошибка GPU сразу
+        # уходит в CPU-фолбэк, а не гоняет NVENC впустую ещё раз.
+        # На CPU повтор без звука спасает и битую аудиодорожку
+        if gpu is not None and "matches no streams" not in str(e):
+            raise
+        audio_dst.unlink(missing_ok=True)
+
+    await run(ffmpeg_cmd([job], gpu, threads, with_audio=False), cores=cores)
+    return False
+
+
+async def transcode_one(job: tuple, gpu: Optional[int], cores: Optional[list[int]]) -> bool:
+    try:
+        return await transcode_single(job, gpu, cores)
+    except RuntimeError:
+        if gpu is None:
+            raise
+    # GPU-цепочка не справилась (драйвер, кодек входа, нехватка сессий) —
+    # рил всё равно собираем, но на CPU
+    return await transcode_single(job, None, cores)
+
+
+async def transcode_batch(jobs: list[tuple], gpu: Optional[int]):
+    cores = next(_CORE_POOL) if _CORE_POOL else None
+    threads = ["-threads", str(len(cores))] if cores else []
+
+    # Вся пачка в одном ffmpeg: один запуск процесса и один CUDA-контекст
+    # на несколько клипов. Клипы без звука (по данным yt-dlp) приходят с
+    # audio_dst=None и пачку не ломают. Цена — латентность: короткий клип
+    # отдаётся только когда готов самый длинный в пачке. TRANSCODE_BATCH=1
+    # отключает пачки, если это важнее пропускной способности
+    if len(jobs) > 1:
+        try:
+            await run(ffmpeg_cmd(jobs, gpu, threads, with_audio=True), cores=cores)
+        except RuntimeError:
+            pass
+        else:
+            for _, _, audio_dst, fut in jobs:
+                fut.set_result(audio_dst is not None)
+            return
+
+    # Пачка упала — разбираем её параллельно, а не по очереди: сессий
+    # столько же, сколько было в пачке, и каждый рил отвечает сам по себе
+    async def resolve(job: tuple):
+        fut = job[3]
+        try:
+            fut.set_result(await transcode_one(job, gpu, cores))
+        except Exception as e:
+            fut.set_exception(e)
+
+    await asyncio.gather(*(resolve(job) for job in jobs))
+
+
+async def transcoder_loop(queue: asyncio.Queue, gpu: Optional[int]):
+    while True:
+        # Берём всё, что уже накопилось в очереди, но не больше TRANSCODE_BATCH
+        jobs = [await queue.get()]
+        while len(jobs) < TRANSCODE_BATCH and not queue.empty():
+            jobs.append(queue.get_nowait())
+
+        try:
+            await transcode_batch(jobs, gpu)
+        except Exception as e:
+            for _, _, _, fut in jobs:
+                if not fut.done():
+                    fut.set_exception(e)
+
+
+# Транскод идёт через воркеры: WORKERS_PER_GPU на каждый GPU.
+# audio_dst=None — в источнике точно нет звука.
+# Возвращает, удалось ли извлечь аудио
+async def transcode_reel(src: Path, video_dst: Path, audio_dst: Optional[Path]) -> bool:
+    fut = asyncio.get_running_loop().create_future()
+    await _TRANSCODE_QUEUE.put((src, video_dst, audio_dst, fut))
+    return await fut
 
 
 # =====================================================
@@ -111,79 +572,138 @@ def extract_audio(src: Path, dst: Path):
 #     ]
 #     run(cmd)
 
-def download_video(url: str, output: Path):
-    cmd = [
-        "yt-dlp",
-        "--remote-components", "ejs:github",
-        "-f", "bestvideo+bestaudio/best",
-        "--merge-output-format", "mp4",
-        "--no-playlist",
-        "--user-agent", USER_AGENT,
-        "-o", str(output.with_suffix(".%(ext)s")),
-        url
+# yt-dlp работает в процессе сервиса: без fork/exec и холодного старта
+# интерпретатора на каждый запрос. Опции собираем из тех же флагов, что и
+# для CLI; outtmpl подставляется на каждый запрос
+YDL_ARGS = [
+    "--remote-components", "ejs:github",
+    "-f", "bestvideo+bestaudio/best",
+    "--merge-output-format", "mp4",
+    "--no-playlist",
+    "--user-agent", USER_AGENT,
+    # DASH/HLS фрагменты качаем параллельно
+    "--concurrent-fragments", "8",
+    "--retries", "3",
+    "--fragment-retries", "5",
+]
+# aria2c тянет один файл в несколько TCP-соединений
+if shutil.which("aria2c"):
+    YDL_ARGS += [
+        "--external-downloader", "aria2c",
+        "--external-downloader-args", "-x 16 -s 16 -k 1M",
     ]
-    run(cmd)
+YDL_OPTS = yt_dlp.parse_options(YDL_ARGS).ydl_opts
+# Ошибку загрузки хотим получить исключением, а не кодом возврата
+YDL_OPTS["ignoreerrors"] = False
+
+# Прогретые YoutubeDL (экстракторы уже загружены после первого запроса).
+# YoutubeDL не потокобезопасен, поэтому каждый инстанс берётся из очереди
+# эксклюзивно. У каждого свои params и свой outtmpl: YoutubeDL дописывает
+# в outtmpl шаблоны по умолчанию, а мы меняем его на каждую загрузку
+YDL_POOL_SIZE = int(os.getenv("YDL_POOL_SIZE", "4"))
+YDL_INSTANCES = [
+    yt_dlp.YoutubeDL({**YDL_OPTS, "outtmpl": {}})
+    for _ in range(YDL_POOL_SIZE)
+]
+# Очередь над ними создаётся в lifespan, в event loop приложения
+_YDL_POOL: Optional[asyncio.Queue] = None
+
+
+# Возвращает, может ли в файле быть звук: acodec "none" — звука точно нет
+def ydl_download(ydl: yt_dlp.YoutubeDL, url: str, output: Path) -> bool:
+    # Имя файла от reel_id, как и в CLI-версии: разные URL одного видео
+    # (youtu.be/X и watch?v=X) не делят один .part
+    ydl.params["outtmpl"]["default"] = str(output.with_suffix(".%(ext)s"))
+    info = ydl.extract_info(url, download=True)
+    # Если yt-dlp не смог смержить в mp4, расширение может отличаться
+    os.replace(info["requested_downloads"][0]["filepath"], output)
+    return info.get("acodec") != "none"
+
+
+async def download_video(url: str, output: Path) -> bool:
+    # raw_video остаётся на диске: mp4 из пайпа не демультиплексируется
+    # (moov может быть в конце), а ffmpeg перечитывает его при повторе без звука
+    ydl = await _YDL_POOL.get()
+    try:
+        return await asyncio.to_thread(ydl_download, ydl, url, output)
+    finally:
+        _YDL_POOL.put_nowait(ydl)
 
 
 # =====================================================
 # API
 # =====================================================
 
-@app.post("/reel", response_model=ReelResponse)
-def create_reel(req: ReelRequest):
-    reel_id = hash_url(req.url)
+# Очереди и транскод-воркеры привязаны к event loop приложения: создаются
+# на старте и гасятся на остановке вместе с недособранными рилами
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global META_DB, _TRANSCODE_QUEUE, _YDL_POOL
+    for d in (VIDEO_DIR, AUDIO_DIR, TMP_DIR):
+        d.mkdir(parents=True, exist_ok=True)
+    META_DB = open_meta_db()
+    _load_meta.cache_clear()
+
+    _TRANSCODE_QUEUE = asyncio.Queue()
+    _YDL_POOL = asyncio.Queue()
+    for ydl in YDL_INSTANCES:
+        _YDL_POOL.put_nowait(ydl)
+    workers = [
+        asyncio.create_task(transcoder_loop(
+            _TRANSCODE_QUEUE,
+            i % N_GPUS if NVENC_AVAILABLE else None
+        ))
+        for i in range(TRANSCODE_WORKERS)
+    ]
+
+    yield
 
+    tasks = [*workers, *_inflight.values()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    META_DB.close()
+
+
+app = FastAPI(title="Reels Backend (Local)", lifespan=lifespan)
+
+
+def reel_response(reel_id: str, meta: dict) -> ReelResponse:
+    return ReelResponse(
+        id=reel_id,
+        videoUrl=f"/reel/{reel_id}.mp4",
+        audioUrl=f"/reel/{reel_id}.wav" if meta["hasAudio"] else None,
+        duration=meta["duration"],
+        width=meta["width"],
+        height=meta["height"]
+    )
+
+
+async def build_reel(url: str, reel_id: str) -> ReelResponse:
     final_video = VIDEO_DIR / f"{reel_id}.mp4"
     final_audio = AUDIO_DIR / f"{reel_id}.wav"
-    meta_file = META_DIR / f"{reel_id}.json"
     raw_video = TMP_DIR / f"{reel_id}_raw.mp4"
 
-    # ---------- CACHE ----------
-    if final_video.exists() and meta_file.exists():
-        meta = json.loads(meta_file.read_text())
-        return ReelResponse(
-            id=reel_id,
-            videoUrl=f"/reel/{reel_id}.mp4",
-            audioUrl=f"/reel/{reel_id}.wav" if meta["hasAudio"] else None,
-            duration=meta["duration"],
-            width=meta["width"],
-            height=meta["height"]
-        )
-
     # ---------- DOWNLOAD ----------
     try:
-        download_video(req.url, raw_video)
+        may_have_audio = await download_video(url, raw_video)
     except Exception as e:
         raise HTTPException(500, f"yt-dlp failed: {e}")
 
-    # ---------- TRANSCODE VIDEO ----------
+    # ---------- TRANSCODE VIDEO + AUDIO ----------
     try:
-        run([
-            "ffmpeg",
-            "-y",
-            "-i", str(raw_video),
-            "-an",
-            "-vf", "scale=720:-2",
-            "-r", "20",
-            "-pix_fmt", "yuv420p",
-            "-movflags", "+faststart",
-            str(final_video)
-        ])
+        has_audio = await transcode_reel(
+            raw_video,
+            final_video,
+            final_audio if may_have_audio else None
+        )
     except Exception as e:
         raise HTTPException(500, f"ffmpeg video failed: {e}")
 
-    # ---------- AUDIO ----------
-    has_audio = False
-    try:
-        extract_audio(raw_video, final_audio)
-        has_audio = True
-    except Exception:
-        final_audio.unlink(missing_ok=True)
-
     raw_video.unlink(missing_ok=True)
 
     # ---------- META ----------
-    duration, width, height = get_video_info(final_video)
+    duration, width, height = await get_video_info(final_video)
 
     meta = {
         "duration": duration,
@@ -191,47 +711,141 @@ def create_reel(req: ReelRequest):
         "height": height,
         "hasAudio": has_audio
     }
-    meta_file.write_text(json.dumps(meta))
+    save_meta(reel_id, meta)
 
-    return ReelResponse(
-        id=reel_id,
-        videoUrl=f"/reel/{reel_id}.mp4",
-        audioUrl=f"/reel/{reel_id}.wav" if has_audio else None,
-        duration=duration,
-        width=width,
-        height=height
+    return reel_response(reel_id, meta)
+
+
+def finish_reel(reel_id: str, task: asyncio.Task):
+    _inflight.pop(reel_id, None)
+    if task.cancelled():
+        return
+    exc = task.exception()
+    if exc is not None:
+        _failed[reel_id] = exc.detail if isinstance(exc, HTTPException) else str(exc)
+        _failed.move_to_end(reel_id)
+        if len(_failed) > FAILED_MAX:
+            _failed.popitem(last=False)
+
+
+@app.post(
+    "/reel",
+    response_model=ReelResponse,
+    responses={202: {"model": ReelStatus}}
+)
+async def create_reel(req: ReelRequest):
+    reel_id = hash_url(req.url)
+
+    # ---------- CACHE ----------
+    meta = cached_meta(reel_id)
+    if meta is not None:
+        return reel_response(reel_id, meta)
+
+    # ---------- BACKGROUND ----------
+    # Промах кэша собирается в фоне, клиент сразу получает 202 и опрашивает
+    # statusUrl. Одинаковые URL, пришедшие одновременно, попадают в один и
+    # тот же пайплайн, а не качают и не перетирают один и тот же raw_video.
+    # Упавший рил повторный POST запускает заново
+    if reel_id not in _inflight:
+        if len(_inflight) >= MAX_INFLIGHT:
+            raise HTTPException(
+                503,
+                "Too many reels in progress, retry later",
+                headers={"Retry-After": "5"}
+            )
+        _failed.pop(reel_id, None)
+        task = asyncio.create_task(build_reel(req.url, reel_id))
+        _inflight[reel_id] = task
+        task.add_done_callback(lambda t: finish_reel(reel_id, t))
+
+    return JSONResponse(
+        status_code=202,
+        content={
+            "id": reel_id,
+            "status": "processing",
+            "statusUrl": f"/reel/{reel_id}/status"
+        }
     )
 
 
+# Состояние processing/failed живёт только в памяти процесса. После
+# рестарта (или когда ошибка вытеснена из _failed) принятый рил отдаёт 404,
+# и клиенту нужно заново сделать POST /reel с тем же URL
+@app.get("/reel/{reel_id}/status", response_model=ReelStatus)
+async def get_status(reel_id: str):
+    status_url = f"/reel/{reel_id}/status"
+
+    meta = cached_meta(reel_id)
+    if meta is not None:
+        return ReelStatus(
+            id=reel_id,
+            status="done",
+            statusUrl=status_url,
+            reel=reel_response(reel_id, meta)
+        )
+
+    if reel_id in _inflight:
+        return ReelStatus(id=reel_id, status="processing", statusUrl=status_url)
+
+    if reel_id in _failed:
+        return ReelStatus(
+            id=reel_id,
+            status="failed",
+            statusUrl=status_url,
+            error=_failed[reel_id]
+        )
+
+    raise HTTPException(404, "Reel not found, POST /reel again")
+
+
 @app.get("/reel/{reel_id}.mp4")
-def get_video(reel_id: str):
-    path = VIDEO_DIR / f"{reel_id}.mp4"
-    if not path.exists():
+async def get_video(reel_id: str):
+    try:
+        return file_response(VIDEO_PREFIX + reel_id + ".mp4", "video/mp4")
+    except FileNotFoundError:
         raise HTTPException(404, "Video not found")
-    return FileResponse(path, media_type="video/mp4", filename=path.name)
 
 
 @app.get("/reel/{reel_id}.wav")
-def get_audio(reel_id: str):
-    path = AUDIO_DIR / f"{reel_id}.wav"
-    if not path.exists():
+async def get_audio(reel_id: str):
+    try:
+        return file_response(AUDIO_PREFIX + reel_id + ".wav", "audio/wav")
+    except FileNotFoundError:
         raise HTTPException(404, "Audio not found")
-    return FileResponse(path, media_type="audio/wav", filename=path.name)
 
 
 @app.post("/storage/clear")
-def clear_storage():
+async def clear_storage():
     def wipe(dir_: Path):
+        # scandir отдаёт тип файла из readdir, без отдельного stat на каждый
         count = 0
-        for f in dir_.glob("*"):
-            if f.is_file():
-                f.unlink()
-                count += 1
+        with os.scandir(dir_) as it:
+            for entry in it:
+                if entry.is_file(follow_symlinks=False):
+                    os.unlink(entry.path)
+                    count += 1
         return count
 
+    # Сначала meta и её LRU: пока файлы удаляются, cache hit уже не случатся
+    meta_count = META_DB.execute("DELETE FROM reels").rowcount
+    _load_meta.cache_clear()
+
+    dirs = {
+        "videos": VIDEO_DIR,
+        "audio": AUDIO_DIR,
+        "tmp": TMP_DIR,
+    }
+    # unlink упирается в I/O, GIL отпускается — чистим каталоги параллельно.
+    # В потоки уходит только wipe: META_DB и _failed трогаем на event loop,
+    # там же, где их меняют save_meta и finish_reel
+    counts = dict(zip(dirs, await asyncio.gather(
+        *(asyncio.to_thread(wipe, d) for d in dirs.values())
+    )))
+    _failed.clear()
+
     return {
-        "videos": wipe(VIDEO_DIR),
-        "audio": wipe(AUDIO_DIR),
-        "meta": wipe(META_DIR),
-        "tmp": wipe(TMP_DIR),
+        "videos": counts["videos"],
+        "audio": counts["audio"],
+        "meta": meta_count,
+        "tmp": counts["tmp"],
     }
@@ -0,0 +1,251 @@
+import asyncio
+import os
+import struct
+import time
+from pathlib import Path
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+
+def box(box_type: bytes, payload: bytes) -> bytes:
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+def mvhd(version: int, timescale: int, duration: int) -> bytes:
+    if version == 1:
+        fields = struct.pack(">QQIQ", 0, 0, timescale, duration)
+    else:
+        fields = struct.pack(">IIII", 0, 0, timescale, duration)
+    return box(b"mvhd", bytes([version, 0, 0, 0]) + fields + bytes(80))
+
+
+def tkhd(version: int, width: int, height: int) -> bytes:
+    if version == 1:
+        times = bytes(8 + 8 + 4 + 4 + 8)
+    else:
+        times = bytes(4 + 4 + 4 + 4 + 4)
+    payload = (
+        bytes([version, 0, 0, 7])
+        + times
+        + bytes(8)   # reserved
+        + bytes(8)   # layer, alternate_group, volume, reserved
+        + bytes(36)  # matrix
+        + struct.pack(">II", width << 16, height << 16)
+    )
+    return box(b"tkhd", payload)
+
+
+def trak(version: int, width: int, height: int) -> bytes:
+    return box(b"trak", tkhd(version, width, height) + box(b"mdia", bytes(16)))
+
+
+def write_mp4(path, moov_children: bytes, faststart: bool = True):
+    ftyp = box(b"ftyp", b"isom" + bytes(4) + b"isomavc1")
+    moov = box(b"moov", moov_children)
+    mdat = box(b"mdat", bytes(64))
+    path.write_bytes(ftyp + moov + mdat if faststart else ftyp + mdat + moov)
+
+
+@pytest.mark.parametrize("version", [0, 1])
+def test_parse_mp4_header(tmp_path, version):
+    path = tmp_path / "reel.mp4"
+    write_mp4(path, mvhd(version, 1000, 12345) + trak(version, 720, 1280))
+
+    assert main.parse_mp4_header(path) == (12.345, 720, 1280)
+
+
+def test_parse_mp4_header_skips_tracks_without_size(tmp_path):
+    path = tmp_path / "reel.mp4"
+    write_mp4(path, mvhd(0, 600, 1200) + trak(0, 0, 0) + trak(0, 720, 404))
+
+    assert main.parse_mp4_header(path) == (2.0, 720, 404)
+
+
+def test_parse_mp4_header_moov_at_end(tmp_path):
+    path = tmp_path / "reel.mp4"
+    write_mp4(path, mvhd(0, 1000, 500) + trak(0, 720, 1280), faststart=False)
+
+    assert main.parse_mp4_header(path) == (0.5, 720, 1280)
+
+
+def test_parse_mp4_header_without_moov(tmp_path):
+    path = tmp_path / "reel.mp4"
+    path.write_bytes(box(b"ftyp", b"isom") + box(b"mdat", bytes(16)))
+
+    with pytest.raises(struct.error):
+        main.parse_mp4_header(path)
+
+
+def fake_ffmpeg(fail_src=None, fail_batches=True):
+    calls = []
+
+    async def run(cmd, capture_stdout=False, cores=None):
+        calls.append(cmd)
+        srcs = [cmd[i + 1] for i, arg in enumerate(cmd) if arg == "-i"]
+        if (fail_batches and len(srcs) > 1) or fail_src in srcs:
+            raise RuntimeError("ffmpeg failed")
+        for i, arg in enumerate(cmd):
+            if arg == "-movflags":
+                Path(cmd[i + 2]).write_bytes(b"")
+
+    return run, calls
+
+
+def test_failed_batch_resolves_each_clip(tmp_path, monkeypatch):
+    run, calls = fake_ffmpeg(fail_src=str(tmp_path / "bad.mp4"))
+    monkeypatch.setattr(main, "run", run)
+
+    async def transcode():
+        loop = asyncio.get_running_loop()
+        jobs = [
+            (tmp_path / f"{name}.mp4", tmp_path / f"{name}_out.mp4", None, loop.create_future())
+            for name in ("good", "bad")
+        ]
+        await main.transcode_batch(jobs, None)
+        return [job[3] for job in jobs]
+
+    good, bad = asyncio.run(transcode())
+
+    assert good.result() is False
+    assert (tmp_path / "good_out.mp4").exists()
+    with pytest.raises(RuntimeError):
+        bad.result()
+    # Пачка и по одному запуску на клип, без повторов на CPU-пути
+    assert len(calls) == 3
+
+
+def test_gpu_failure_goes_straight_to_cpu(tmp_path, monkeypatch):
+    calls = []
+
+    async def run(cmd, capture_stdout=False, cores=None):
+        calls.append(cmd)
+        if "-hwaccel_device" in cmd:
+            raise RuntimeError("No NVENC capable devices found")
+
+    monkeypatch.setattr(main, "run", run)
+    # На машине без NVENC GPU-аргументы не определены
+    monkeypatch.setattr(main, "GPU_INPUT_ARGS", ["-hwaccel", "cuda"], raising=False)
+    monkeypatch.setattr(main, "GPU_OUTPUT_ARGS", ["-c:v", "h264_nvenc"], raising=False)
+    job = (tmp_path / "src.mp4", tmp_path / "out.mp4", tmp_path / "out.wav", None)
+
+    assert asyncio.run(main.transcode_one(job, 0, None)) is True
+    assert [("-hwaccel_device" in cmd) for cmd in calls] == [True, False]
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    storage = tmp_path / "storage"
+    monkeypatch.setattr(main, "STORAGE", storage)
+    monkeypatch.setattr(main, "STORAGE_PREFIX", str(storage) + os.sep)
+    monkeypatch.setattr(main, "VIDEO_DIR", storage / "videos")
+    monkeypatch.setattr(main, "AUDIO_DIR", storage / "audio")
+    monkeypatch.setattr(main, "TMP_DIR", storage / "tmp")
+    monkeypatch.setattr(main, "VIDEO_PREFIX", str(storage / "videos") + os.sep)
+    monkeypatch.setattr(main, "AUDIO_PREFIX", str(storage / "audio") + os.sep)
+
+    downloads = []
+
+    async def download_video(url, output):
+        downloads.append(url)
+        # Даём второму POST застать сборку в процессе
+        await asyncio.sleep(0.05)
+        if "broken" in url:
+            raise RuntimeError("Video unavailable")
+        output.write_bytes(b"")
+        return False
+
+    async def get_video_info(path):
+        return 1.5, 720, 1280
+
+    run, _ = fake_ffmpeg(fail_batches=False)
+    monkeypatch.setattr(main, "download_video", download_video)
+    monkeypatch.setattr(main, "get_video_info", get_video_info)
+    monkeypatch.setattr(main, "run", run)
+
+    with TestClient(main.app) as c:
+        c.downloads = downloads
+        yield c
+
+
+def wait_status(client, status_url):
+    for _ in range(100):
+        body = client.get(status_url).json()
+        if body["status"] != "processing":
+            return body
+        time.sleep(0.01)
+    raise AssertionError("reel is still processing")
+
+
+def test_create_reel_in_background(client):
+    r = client.post("/reel", json={"url": "https://youtu.be/ok"})
+    assert r.status_code == 202
+
+    body = wait_status(client, r.json()["statusUrl"])
+    assert body["status"] == "done"
+    assert body["reel"]["duration"] == 1.5
+    assert body["reel"]["audioUrl"] is None
+
+    # Готовый рил отдаётся сразу, без повторной сборки
+    r = client.post("/reel", json={"url": "https://youtu.be/ok"})
+    assert r.status_code == 200
+    assert client.downloads == ["https://youtu.be/ok"]
+
+
+def test_failed_reel_reports_error(client):
+    r = client.post("/reel", json={"url": "https://youtu.be/broken"})
+    assert r.status_code == 202
+
+    body = wait_status(client, r.json()["statusUrl"])
+    assert body["status"] == "failed"
+    assert "Video unavailable" in body["error"]
+
+
+def test_duplicate_posts_share_one_build(client):
+    first = client.post("/reel", json={"url": "https://youtu.be/ok"})
+    second = client.post("/reel", json={"url": "https://youtu.be/ok"})
+    assert first.json()["id"] == second.json()["id"]
+
+    assert wait_status(client, first.json()["statusUrl"])["status"] == "done"
+    assert client.downloads == ["https://youtu.be/ok"]
+
+
+def test_inflight_limit(client, monkeypatch):
+    monkeypatch.setattr(main, "MAX_INFLIGHT", 1)
+    first = client.post("/reel", json={"url": "https://youtu.be/ok"})
+    assert first.status_code == 202
+
+    r = client.post("/reel", json={"url": "https://youtu.be/other"})
+    assert r.status_code == 503
+    assert "Retry-After" in r.headers
+    # Уже принятый рил повторный POST не отклоняет
+    assert client.post("/reel", json={"url": "https://youtu.be/ok"}).status_code == 202
+
+    wait_status(client, first.json()["statusUrl"])
+
+
+def test_missing_mp4_rebuilds_reel(client):
+    r = client.post("/reel", json={"url": "https://youtu.be/ok"})
+    wait_status(client, r.json()["statusUrl"])
+
+    (main.VIDEO_DIR / f"{r.json()['id']}.mp4").unlink()
+    r = client.post("/reel", json={"url": "https://youtu.be/ok"})
+    assert r.status_code == 202
+    assert wait_status(client, r.json()["statusUrl"])["status"] == "done"
+    assert len(client.downloads) == 2
+
+
+def test_clear_storage(client):
+    ok = client.post("/reel", json={"url": "https://youtu.be/ok"})
+    broken = client.post("/reel", json={"url": "https://youtu.be/broken"})
+    wait_status(client, ok.json()["statusUrl"])
+    wait_status(client, broken.json()["statusUrl"])
+
+    (main.TMP_DIR / "leftover_raw.mp4").write_bytes(b"")
+
+    r = client.post("/storage/clear")
+    assert r.json() == {"videos": 1, "audio": 0, "meta": 1, "tmp": 1}
+    assert client.get(ok.json()["statusUrl"]).status_code == 404
+    assert client.get(broken.json()["statusUrl"]).status_code == 404